@@ -5,9 +5,24 @@ import argparse
 import subprocess
 import shutil
 import platform
+import json
+import time
+import threading
+import contextlib
+import types
+import cProfile
+import pstats
 import yt_dlp as youtube_dl
+from yt_dlp.postprocessor.common import PostProcessor
+from yt_dlp.utils import PostProcessingError
+from mutagen import MutagenError
+from mutagen.id3 import ID3, ID3NoHeaderError, APIC, COMM, TALB, TCON, TDRC, TIT2, TPE1, TRCK, WOAS
 import traceback
 
+# Number of HLS segments fetched in parallel for a single track
+DEFAULT_CONCURRENT_FRAGMENTS = 4
+MAX_CONCURRENT_FRAGMENTS = 16
+
 def get_bundled_ffmpeg_path():
     """Get the path to the bundled FFmpeg binary if available."""
     # Check if we're running from a PyInstaller bundle
@@ -29,6 +44,17 @@ def get_bundled_ffmpeg_path():
     print(f"DEBUG: FFmpeg found: {result is not None}")
     return result
 
+def reset_client_id(cache_dir=None):
+    """Invalidate the cached SoundCloud client_id so it is rediscovered on the next download."""
+    # Same invalidation yt-dlp's SoundCloud extractor does on a 401/403;
+    # only that cache entry is touched, nothing is deleted
+    options = {'logger': CustomLogger()}
+    if cache_dir:
+        options['cachedir'] = cache_dir
+    with youtube_dl.YoutubeDL(options) as ydl:
+        print("DEBUG: Clearing cached SoundCloud client_id")
+        ydl.cache.store('soundcloud', 'client_id', None)
+
 def check_dependencies():
     """Check if necessary dependencies are installed or bundled."""
     missing_deps = []
@@ -44,13 +70,6 @@ def check_dependencies():
         if ffmpeg_in_path is None:
             missing_deps.append("FFmpeg")
     
-    # Check for AtomicParsley on macOS (needed for embedding thumbnails)
-    if platform.system() == 'Darwin':
-        atomicparsley = shutil.which('AtomicParsley')
-        print(f"DEBUG: AtomicParsley in PATH: {atomicparsley}")
-        if atomicparsley is None:
-            missing_deps.append("AtomicParsley")
-    
     if missing_deps:
         print("ERROR: The following dependencies are missing:")
         for dep in missing_deps:
@@ -59,9 +78,6 @@ def check_dependencies():
                 print("    - Windows: Download and add to PATH")
                 print("    - macOS: Use 'brew install ffmpeg'")
                 print("    - Linux: Use 'sudo apt install ffmpeg' or equivalent")
-            elif dep == "AtomicParsley":
-                print("  - AtomicParsley: Required for embedding thumbnails on macOS")
-                print("    - macOS: Use 'brew install atomicparsley'")
         return False
     return True
 
@@ -72,7 +88,7 @@ def is_valid_soundcloud_url(url):
     print(f"DEBUG: URL validation for {url}: {result}")
     return result
 
-def setup_youtube_dl_options(download_path='.'):
+def setup_youtube_dl_options(download_path='.', cache_dir=None, concurrent_fragments=DEFAULT_CONCURRENT_FRAGMENTS):
     """Configure youtube-dl options for SoundCloud downloads."""
     # Check for bundled FFmpeg and use it if available
     bundled_ffmpeg = get_bundled_ffmpeg_path()
@@ -87,20 +103,30 @@ def setup_youtube_dl_options(download_path='.'):
                 'preferredquality': '320',  # Set to highest available quality
             },
             {
-                'key': 'EmbedThumbnail',  # Embed artwork as metadata
+                'key': 'FFmpegThumbnailsConvertor',  # Convert WebP etc. artwork for the APIC frame
+                'format': 'jpg',
+                'when': 'before_dl',
             },
-            {
-                'key': 'FFmpegMetadata',  # Add metadata to file
-            }
         ],
+        # Tags and artwork are written by ID3TagPostProcessor after the encode
         'writethumbnail': True,  # Write the thumbnail to disk
         'prefer_ffmpeg': True,
         'keepvideo': False,
         'verbose': True,
         'ignoreerrors': True,  # Skip unavailable tracks in playlists
         'logger': CustomLogger(),  # Add custom logger for debug output
+        # HLS streams: fetch segments in parallel with yt-dlp's native downloader,
+        # which reassembles them in order and reuses pooled keep-alive connections
+        'external_downloader': {'m3u8': 'native'},
+        'concurrent_fragment_downloads': min(MAX_CONCURRENT_FRAGMENTS, max(1, concurrent_fragments)),
+        'skip_unavailable_fragments': False,  # Fail rather than leave gaps in the audio
     }
     
+    # yt-dlp caches the SoundCloud client_id in its own cache directory by default
+    if cache_dir:
+        print(f"DEBUG: Setting yt-dlp cache directory to: {cache_dir}")
+        options['cachedir'] = cache_dir
+    
     # Add bundled FFmpeg path if available
     if bundled_ffmpeg:
         ffmpeg_dir = os.path.dirname(bundled_ffmpeg)
@@ -123,7 +149,189 @@ class CustomLogger:
     def error(self, msg):
         print(f"YT-DLP ERROR: {msg}")
 
-def download_soundcloud(url, download_path='.'):
+class ID3TagPostProcessor(PostProcessor):
+    """Write ID3v2 tags and APIC artwork into the extracted MP3 with mutagen.
+    
+    Replaces the EmbedThumbnail and FFmpegMetadata postprocessors, each of which
+    spawned ffmpeg (or AtomicParsley) and wrote a new copy of the audio file.
+    This needs no subprocess and saves all tags at once, but it is not free:
+    ffmpeg's ID3 tag has no padding, so adding artwork makes mutagen shift the
+    audio data in place, which rewrites the rest of the file once more.
+    """
+    def run(self, info):
+        filepath = info.get('filepath')
+        if not filepath or not filepath.lower().endswith('.mp3'):
+            self.to_screen(f'Skipping tagging of non-MP3 file: {filepath}')
+            return [], info
+        
+        try:
+            return self._write_tags(filepath, info)
+        except (MutagenError, OSError) as e:
+            raise PostProcessingError(f'Unable to write ID3 tags to "{filepath}": {e}')
+    
+    def _write_tags(self, filepath, info):
+        try:
+            tags = ID3(filepath)
+        except ID3NoHeaderError:
+            tags = ID3()
+        
+        text_frames = [
+            (TIT2, info.get('track') or info.get('title')),
+            (TPE1, info.get('artist') or info.get('uploader')),
+            (TALB, info.get('album')),
+            (TCON, info.get('genre')),
+            (TRCK, info.get('track_number')),
+        ]
+        for frame, value in text_frames:
+            if value:
+                tags.setall(frame.__name__, [frame(encoding=3, text=str(value))])
+        
+        upload_date = info.get('upload_date')
+        if upload_date and len(upload_date) == 8:
+            date = f'{upload_date[:4]}-{upload_date[4:6]}-{upload_date[6:]}'
+            tags.setall('TDRC', [TDRC(encoding=3, text=date)])
+        
+        if info.get('description'):
+            tags.setall('COMM', [COMM(encoding=3, lang='eng', desc='', text=info['description'])])
+        
+        if info.get('webpage_url'):
+            tags.setall('WOAS', [WOAS(url=info['webpage_url'])])
+        
+        files_to_delete = []
+        thumbnail_path = self._get_thumbnail_path(info)
+        if thumbnail_path:
+            with open(thumbnail_path, 'rb') as f:
+                image_data = f.read()
+            mime = self._get_image_mime(image_data)
+            if mime:
+                tags.setall('APIC', [APIC(encoding=3, mime=mime, type=3, desc='Cover', data=image_data)])
+            else:
+                self.report_warning(f'Unsupported thumbnail format in "{thumbnail_path}", skipping artwork')
+            files_to_delete.append(thumbnail_path)
+            info.get('__files_to_move', {}).pop(thumbnail_path, None)
+        else:
+            self.report_warning('No thumbnail found on disk, skipping artwork')
+        
+        self.to_screen(f'Writing ID3 tags to "{filepath}"')
+        tags.save(filepath, v2_version=3)
+        return files_to_delete, info
+    
+    @staticmethod
+    def _get_image_mime(image_data):
+        # Thumbnails are converted to JPEG before download, but check the actual bytes
+        if image_data.startswith(b'\xff\xd8\xff'):
+            return 'image/jpeg'
+        if image_data.startswith(b'\x89PNG\r\n\x1a\n'):
+            return 'image/png'
+        return None
+    
+    @staticmethod
+    def _get_thumbnail_path(info):
+        for thumbnail in reversed(info.get('thumbnails') or []):
+            path = thumbnail.get('filepath')
+            if path and os.path.exists(path):
+                return path
+        return None
+
+class Tracer:
+    """Collect timed spans for a download run and export them as Chrome trace events.
+    
+    The resulting JSON can be opened in chrome://tracing or ui.perfetto.dev.
+    """
+    def __init__(self):
+        self.events = []
+        self._origin = time.perf_counter()
+    
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            self.events.append({
+                'name': name,
+                'cat': 'download',
+                'ph': 'X',  # Complete event
+                'ts': (start - self._origin) * 1e6,  # Microseconds
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': {'worker': thread.name, **{k: v for k, v in args.items() if v is not None}},
+            })
+    
+    def save(self, path):
+        """Write the collected spans to path as trace-event JSON."""
+        # Name each thread after its worker so the viewer labels the rows
+        workers = {e['tid']: e['args']['worker'] for e in self.events}
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+            for tid, name in workers.items()
+        ]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, f)
+        print(f"DEBUG: Wrote {len(self.events)} trace spans to {path}")
+
+class TracingYoutubeDL(youtube_dl.YoutubeDL):
+    """YoutubeDL that records a span for each phase of a download.
+    
+    Only used when tracing is enabled, so normal runs pay nothing for it.
+    """
+    def __init__(self, params, tracer):
+        super().__init__(params)
+        self.tracer = tracer
+    
+    def get_info_extractor(self, ie_key):
+        ie = super().get_info_extractor(ie_key)
+        # Time the extractor's own extract call (URL resolution, API requests);
+        # extract_info and its error handling are left untouched
+        if not getattr(ie, '_traced_extract', False):
+            extract = ie.extract
+            
+            def traced_extract(url):
+                with self.tracer.span('extract', extractor=ie_key, url=url):
+                    return extract(url)
+            
+            ie.extract = traced_extract
+            ie._traced_extract = True
+        return ie
+    
+    def process_ie_result(self, ie_result, *args, **kwargs):
+        entries = ie_result.get('entries')
+        if ie_result.get('_type') == 'playlist' and isinstance(entries, types.GeneratorType):
+            ie_result['entries'] = self._trace_entries(entries, ie_result.get('id'))
+        return super().process_ie_result(ie_result, *args, **kwargs)
+    
+    def _trace_entries(self, entries, playlist_id):
+        # Lazily paginated playlists fetch their pages while being iterated, so time
+        # each step of the iteration rather than the per-entry downloads around it
+        while True:
+            with self.tracer.span('playlist_entries', playlist_id=playlist_id):
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    return
+            yield entry
+    
+    def process_info(self, info_dict):
+        with self.tracer.span('track', track_id=info_dict.get('id')):
+            return super().process_info(info_dict)
+    
+    def dl(self, name, info, *args, **kwargs):
+        with self.tracer.span('transfer', track_id=info.get('id')):
+            return super().dl(name, info, *args, **kwargs)
+    
+    def _write_thumbnails(self, label, info_dict, *args, **kwargs):
+        with self.tracer.span('thumbnail', track_id=info_dict.get('id')):
+            return super()._write_thumbnails(label, info_dict, *args, **kwargs)
+    
+    def run_pp(self, pp, infodict):
+        with self.tracer.span(f'postprocess:{pp.PP_NAME}', track_id=infodict.get('id')):
+            return super().run_pp(pp, infodict)
+
+def download_soundcloud(url, download_path='.', cache_dir=None, tracer=None,
+                        concurrent_fragments=DEFAULT_CONCURRENT_FRAGMENTS):
     """Download audio from SoundCloud URL (single track or playlist)."""
     print(f"DEBUG: Starting download from {url} to {download_path}")
     
@@ -134,13 +342,21 @@ def download_soundcloud(url, download_path='.'):
     if not check_dependencies():
         return False
     
-    options = setup_youtube_dl_options(download_path)
+    options = setup_youtube_dl_options(download_path, cache_dir, concurrent_fragments)
     
     try:
         print("DEBUG: Initializing YoutubeDL")
-        with youtube_dl.YoutubeDL(options) as ydl:
+        if tracer:
+            ydl_context = TracingYoutubeDL(options, tracer)
+        else:
+            ydl_context = youtube_dl.YoutubeDL(options)
+        
+        with ydl_context as ydl:
+            # Runs after FFmpegExtractAudio from the options
+            ydl.add_post_processor(ID3TagPostProcessor(ydl), when='post_process')
             print("DEBUG: Extracting info and downloading")
-            info = ydl.extract_info(url, download=True)
+            with tracer.span('download_soundcloud', url=url) if tracer else contextlib.nullcontext():
+                info = ydl.extract_info(url, download=True)
             
             # Check if download was successful
             if info is None:
@@ -164,19 +380,62 @@ def download_soundcloud(url, download_path='.'):
         traceback.print_exc()
         return False
 
+def concurrent_fragments_type(value):
+    """argparse type for --concurrent-fragments: an int between 1 and the maximum."""
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if not 1 <= count <= MAX_CONCURRENT_FRAGMENTS:
+        raise argparse.ArgumentTypeError(f"must be between 1 and {MAX_CONCURRENT_FRAGMENTS}")
+    return count
+
 def main():
     parser = argparse.ArgumentParser(description='Download SoundCloud tracks or playlists at high quality')
     parser.add_argument('url', help='SoundCloud URL (track or playlist)')
     parser.add_argument('-o', '--output', default='downloads', help='Output directory (default: downloads)')
+    parser.add_argument('--cache-dir', default=None, help="Directory for yt-dlp's cache, including the SoundCloud client ID (default: yt-dlp's own)")
+    parser.add_argument('--reset-client-id', action='store_true', help='Discard the cached SoundCloud client ID before downloading')
+    parser.add_argument('-N', '--concurrent-fragments', type=concurrent_fragments_type, default=DEFAULT_CONCURRENT_FRAGMENTS,
+                        help=f'Number of HLS segments to download in parallel, 1-{MAX_CONCURRENT_FRAGMENTS} '
+                             f'(default: {DEFAULT_CONCURRENT_FRAGMENTS})')
+    parser.add_argument('--trace', metavar='FILE', default=None, help='Write a Chrome/Perfetto trace of the download phases to FILE')
+    parser.add_argument('--profile', metavar='FILE', default=None, help='Write a cProfile dump to FILE and print the hottest functions')
     
     args = parser.parse_args()
     
+    if args.reset_client_id:
+        reset_client_id(args.cache_dir)
+    
     # Create output directory if it doesn't exist
     if not os.path.exists(args.output):
         os.makedirs(args.output)
     
+    tracer = Tracer() if args.trace else None
+    profiler = cProfile.Profile() if args.profile else None
+    
     # Download from the provided URL
-    if download_soundcloud(args.url, args.output):
+    if profiler:
+        profiler.enable()
+    try:
+        success = download_soundcloud(args.url, args.output, args.cache_dir, tracer, args.concurrent_fragments)
+    finally:
+        if profiler:
+            profiler.disable()
+            try:
+                profiler.dump_stats(args.profile)
+            except OSError as e:
+                print(f"Error saving profile to {args.profile}: {e}")
+            else:
+                print(f"DEBUG: Wrote profile to {args.profile}, hottest functions:")
+                pstats.Stats(profiler).sort_stats('tottime').print_stats(20)
+        if tracer:
+            try:
+                tracer.save(args.trace)
+            except OSError as e:
+                print(f"Error saving trace to {args.trace}: {e}")
+    
+    if success:
         print(f"Download completed. Files saved to {os.path.abspath(args.output)}")
     else:
         print("Download failed.")
@@ -5,10 +5,12 @@ from tkinter import filedialog, messagebox, ttk
 import threading
 import platform
 import json
+import time
 
 # Try to import soundcloud_downloader functions, with fallback for PyInstaller bundle
 try:
-    from soundcloud_downloader import download_soundcloud, check_dependencies, is_valid_soundcloud_url
+    from soundcloud_downloader import (download_soundcloud, check_dependencies, is_valid_soundcloud_url, Tracer,
+                                       DEFAULT_CONCURRENT_FRAGMENTS, MAX_CONCURRENT_FRAGMENTS)
 except ModuleNotFoundError:
     # If running from PyInstaller bundle, we need to handle imports differently
     try:
@@ -29,7 +31,8 @@ except ModuleNotFoundError:
             sys.exit(1)
             
         # Now try importing from soundcloud_downloader
-        from soundcloud_downloader import download_soundcloud, check_dependencies, is_valid_soundcloud_url
+        from soundcloud_downloader import (download_soundcloud, check_dependencies, is_valid_soundcloud_url, Tracer,
+                                           DEFAULT_CONCURRENT_FRAGMENTS, MAX_CONCURRENT_FRAGMENTS)
     except Exception as e:
         # Show error and exit if we can't import the required modules
         if 'tkinter' in sys.modules:
@@ -48,7 +51,7 @@ class SoundCloudDownloaderGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Bertux best DJ Songs Downloader")
-        self.root.geometry("600x400")
+        self.root.geometry("600x450")
         self.root.resizable(True, True)
         
         # Config file path
@@ -76,7 +79,9 @@ class SoundCloudDownloaderGUI:
     def load_settings(self):
         """Load saved settings from config file"""
         default_settings = {
-            'output_dir': os.path.join(os.path.expanduser("~"), "Downloads", "SoundCloud")
+            'output_dir': os.path.join(os.path.expanduser("~"), "Downloads", "SoundCloud"),
+            'debug_trace': False,
+            'concurrent_fragments': DEFAULT_CONCURRENT_FRAGMENTS
         }
         
         try:
@@ -128,6 +133,15 @@ class SoundCloudDownloaderGUI:
         browse_btn = ttk.Button(dir_frame, text="Browse...", command=self.browse_directory)
         browse_btn.pack(side=tk.LEFT)
         
+        # Number of HLS segments fetched in parallel
+        frag_frame = ttk.Frame(main_frame)
+        frag_frame.pack(fill=tk.X, pady=10)
+        
+        ttk.Label(frag_frame, text="Parallel segments:").pack(side=tk.LEFT, padx=(0, 10))
+        self.fragments_var = tk.IntVar(value=self.settings['concurrent_fragments'])
+        fragments_spin = ttk.Spinbox(frag_frame, from_=1, to=MAX_CONCURRENT_FRAGMENTS, textvariable=self.fragments_var, width=5)
+        fragments_spin.pack(side=tk.LEFT)
+        
         # Status and progress
         status_frame = ttk.LabelFrame(main_frame, text="Status")
         status_frame.pack(fill=tk.BOTH, expand=True, pady=10)
@@ -149,6 +163,12 @@ class SoundCloudDownloaderGUI:
         quit_btn = ttk.Button(btn_frame, text="Quit", command=self.root.destroy)
         quit_btn.pack(side=tk.RIGHT, padx=5)
         
+        # Debug toggle: write a trace of the download phases to the output directory
+        self.trace_var = tk.BooleanVar(value=self.settings['debug_trace'])
+        trace_check = ttk.Checkbutton(btn_frame, text="Write debug trace", variable=self.trace_var,
+                                      command=self.toggle_trace)
+        trace_check.pack(side=tk.LEFT)
+        
     def browse_directory(self):
         directory = filedialog.askdirectory(
             initialdir=self.dir_var.get(),
@@ -160,13 +180,28 @@ class SoundCloudDownloaderGUI:
             self.settings['output_dir'] = directory
             self.save_settings()
     
+    def toggle_trace(self):
+        self.settings['debug_trace'] = self.trace_var.get()
+        self.save_settings()
+    
     def start_download(self):
         url = self.url_var.get().strip()
         output_dir = self.dir_var.get()
         
-        # Save the current output directory
-        if output_dir != self.settings['output_dir']:
+        try:
+            concurrent_fragments = self.fragments_var.get()
+        except tk.TclError:
+            concurrent_fragments = None
+        # The Spinbox range does not constrain typed-in values
+        if concurrent_fragments is None or not 1 <= concurrent_fragments <= MAX_CONCURRENT_FRAGMENTS:
+            messagebox.showerror("Error", f"Parallel segments must be a whole number from 1 to {MAX_CONCURRENT_FRAGMENTS}")
+            return
+        
+        # Save the current output directory and segment count
+        if (output_dir != self.settings['output_dir'] or
+                concurrent_fragments != self.settings['concurrent_fragments']):
             self.settings['output_dir'] = output_dir
+            self.settings['concurrent_fragments'] = concurrent_fragments
             self.save_settings()
         
         if not url:
@@ -195,17 +230,32 @@ class SoundCloudDownloaderGUI:
         self.progress.start()
         
         # Start download in a separate thread to avoid freezing the UI
-        threading.Thread(target=self.download_thread, args=(url, output_dir), daemon=True).start()
+        tracer = Tracer() if self.trace_var.get() else None
+        threading.Thread(target=self.download_thread, args=(url, output_dir, tracer, concurrent_fragments),
+                         daemon=True).start()
     
-    def download_thread(self, url, output_dir):
+    def download_thread(self, url, output_dir, tracer=None, concurrent_fragments=DEFAULT_CONCURRENT_FRAGMENTS):
         try:
-            success = download_soundcloud(url, output_dir)
+            try:
+                success = download_soundcloud(url, output_dir, tracer=tracer,
+                                              concurrent_fragments=concurrent_fragments)
+            finally:
+                if tracer:
+                    self.save_trace(tracer, output_dir)
             
             # Update UI in the main thread
             self.root.after(0, self.download_complete, success, output_dir)
         except Exception as e:
             self.root.after(0, self.download_error, str(e))
     
+    def save_trace(self, tracer, output_dir):
+        # A trace that can't be written must not turn the download into a failure
+        trace_path = os.path.join(output_dir, f"soundcloud_trace_{time.strftime('%Y%m%d_%H%M%S')}.json")
+        try:
+            tracer.save(trace_path)
+        except Exception as e:
+            print(f"Error saving trace: {e}")
+    
     def download_complete(self, success, output_dir):
         self.progress.stop()
         self.download_btn.config(state=tk.NORMAL)